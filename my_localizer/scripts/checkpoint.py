@@ -0,0 +1,141 @@
+""" Periodically saves the state of the particle filter to disk so that a restarted
+    node can resume localizing instead of starting over """
+
+import rospy
+
+import hashlib
+import mmap
+import os
+import struct
+from threading import Lock
+
+import numpy as np
+
+class FilterCheckpoint(object):
+    """ Writes and reads a compact binary snapshot of the particle filter.  The file holds a fixed
+        size header followed by the particle x, y, theta and weight arrays as little endian doubles.
+        Attributes:
+            path: the file the checkpoint is stored in
+            enabled: whether checkpointing is turned on, when it is off nothing is saved or loaded
+            map_hash: a SHA-1 digest of the map, a checkpoint is only resumed if it was taken on the same map
+            pending: the most recent snapshot that has not been written to disk yet (or None)
+            lock: guards pending, which is set from the scan callback
+            write_lock: serializes writes so the timer and the shutdown hook never write the file at once
+            timer: periodically writes the pending snapshot from its own thread (None if disabled)
+    """
+
+    MAGIC = b'PFCK'
+    VERSION = 1
+    # magic, version, map hash, number of particles, odom (x,y,theta), map to odom (x,y,theta)
+    HEADER = struct.Struct('<4sI20sI6d')
+
+    def __init__(self, path, map, rate=1.0):
+        """ Construct a new FilterCheckpoint
+            path: the file to store the checkpoint in
+            map: the map the filter is localizing in (nav_msgs/OccupancyGrid)
+            rate: how often (in Hz) to write the checkpoint, a rate of zero disables checkpointing
+                  altogether (nothing is saved, written on shutdown or resumed) """
+        self.path = path
+        self.enabled = rate > 0
+        self.map_hash = self.hash_map(map)
+        self.pending = None
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.timer = None
+        if self.enabled:
+            self.timer = rospy.Timer(rospy.Duration(1.0/rate), self.write_pending)
+
+    @staticmethod
+    def hash_map(map):
+        """ Compute a digest of the map geometry and contents """
+        info = map.info
+        origin = info.origin
+        digest = hashlib.sha1()
+        digest.update(struct.pack('<IIf7d', info.width, info.height, info.resolution,
+                                  origin.position.x, origin.position.y, origin.position.z,
+                                  origin.orientation.x, origin.orientation.y,
+                                  origin.orientation.z, origin.orientation.w))
+        digest.update(np.asarray(map.data, dtype=np.int8).tobytes())
+        return digest.digest()
+
+    def save(self, particle_cloud, odom_xy_theta, map_to_odom_xy_theta):
+        """ Take a snapshot of the filter state to be written out on the next timer tick.  This
+            is cheap so it can be called from the scan callback.
+            particle_cloud: a list of particles
+            odom_xy_theta: the odometric pose of the robot at the last filter update
+            map_to_odom_xy_theta: the offset between the map and odometry frames as (x,y,theta) """
+        if not(self.enabled):
+            return
+        particles = np.array([[p.x for p in particle_cloud],
+                              [p.y for p in particle_cloud],
+                              [p.theta for p in particle_cloud],
+                              [p.w for p in particle_cloud]], dtype='<f8')
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, self.map_hash, len(particle_cloud),
+                                  *(tuple(odom_xy_theta) + tuple(map_to_odom_xy_theta)))
+        with self.lock:
+            self.pending = header + particles.tobytes()
+
+    def write_pending(self, event=None):
+        """ Atomically replace the checkpoint file with the pending snapshot, if there is one """
+        with self.write_lock:
+            # take the snapshot while holding the write lock so an older snapshot can never overwrite a newer one
+            with self.lock:
+                data = self.pending
+                self.pending = None
+            if data is None:
+                return
+
+            # write to a temporary file and rename it over the old one so a crash never leaves a partial checkpoint
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError) as exc:
+                rospy.logwarn("Could not write checkpoint " + self.path + ": " + str(exc))
+
+    def shutdown(self):
+        """ Stop the periodic writes and flush the last snapshot to disk """
+        if self.timer is not None:
+            self.timer.shutdown()
+        self.write_pending()
+
+    def load(self):
+        """ Read the checkpoint from disk.  Returns None if there is no usable checkpoint, otherwise a
+            tuple (particles, odom_xy_theta, map_to_odom_xy_theta) where particles is a 4xN array of
+            particle x, y, theta and weight """
+        if not(self.enabled):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < self.HEADER.size:
+                    return None
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            return None
+
+        try:
+            fields = self.HEADER.unpack_from(data)
+            (magic, version, map_hash, n) = fields[:4]
+            if magic != self.MAGIC or version != self.VERSION:
+                rospy.logwarn("Ignoring checkpoint " + self.path + ": unrecognized format")
+                return None
+            if map_hash != self.map_hash:
+                rospy.logwarn("Ignoring checkpoint " + self.path + ": it was taken on a different map")
+                return None
+            if n == 0 or size != self.HEADER.size + 4*8*n:
+                rospy.logwarn("Ignoring checkpoint " + self.path + ": it is truncated")
+                return None
+            particles = np.frombuffer(data, dtype='<f8', count=4*n, offset=self.HEADER.size).reshape(4, n)
+            # copy out of the mapping so it can be closed
+            particles = np.array(particles, dtype=float)
+        finally:
+            data.close()
+
+        if not(np.all(np.isfinite(particles))):
+            rospy.logwarn("Ignoring checkpoint " + self.path + ": it contains invalid particles")
+            return None
+        return (particles, fields[4:7], fields[7:10])
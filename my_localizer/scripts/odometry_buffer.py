@@ -0,0 +1,79 @@
+""" A short history of odometry poses that can be queried at arbitrary timestamps
+    so that the particle filter never has to block on tf in its scan callback """
+
+import rospy
+
+from collections import deque
+from threading import Lock
+
+from helper_functions import convert_pose_to_xy_and_theta, angle_normalize, angle_diff
+
+class OdometryBuffer(object):
+    """ Stores recent odometry poses and interpolates between them
+        Attributes:
+            odom_frame: the frame the odometry poses are expected to be expressed in
+            base_frame: the frame the odometry poses are expected to describe
+            duration: how many seconds of odometry history to keep
+            tolerance: how far (in seconds) past the newest sample a query may be and still be answered
+                       with the newest sample instead of failing
+            samples: a deque of (stamp, x, y, theta) tuples ordered from oldest to newest, where
+                     stamp is in seconds and (x, y, theta) is the pose of the base in the odometry frame
+            warned_frames: whether we have already complained about odometry in unexpected frames
+    """
+
+    def __init__(self, odom_frame, base_frame, duration=2.0, tolerance=0.1):
+        self.odom_frame = odom_frame
+        self.base_frame = base_frame
+        self.duration = duration
+        self.tolerance = tolerance
+        self.samples = deque()
+        self.lock = Lock()      # odometry and scan callbacks run on separate threads
+        self.warned_frames = False
+
+    def odom_received(self, msg):
+        """ Callback for nav_msgs/Odometry messages, records the pose of the base in the odometry frame """
+        if not(self.warned_frames) and (msg.header.frame_id.lstrip('/') != self.odom_frame.lstrip('/') or
+                                        msg.child_frame_id.lstrip('/') != self.base_frame.lstrip('/')):
+            # the pose we store would not be the pose of the base in the odometry frame
+            rospy.logwarn("Expected odometry of " + self.base_frame + " in " + self.odom_frame + " but got " +
+                          msg.child_frame_id + " in " + msg.header.frame_id)
+            self.warned_frames = True
+        xy_theta = convert_pose_to_xy_and_theta(msg.pose.pose)
+        stamp = msg.header.stamp.to_sec()
+        with self.lock:
+            if self.samples and stamp < self.samples[-1][0]:
+                # time went backwards (e.g. a restarted bag or simulator), so the history is useless
+                self.samples.clear()
+            self.samples.append((stamp,) + tuple(xy_theta))
+            while self.samples[-1][0] - self.samples[0][0] > self.duration:
+                self.samples.popleft()
+
+    def get_xy_theta(self, stamp=None):
+        """ Return the odometry pose as an (x,y,theta) tuple at the given time (rospy.Time).  If stamp is
+            omitted or zero the newest pose is returned.  Returns None if the buffer does not cover stamp. """
+        with self.lock:
+            if not(self.samples):
+                return None
+            newest = self.samples[-1]
+            if stamp is None or stamp.is_zero():
+                return newest[1:]
+            t = stamp.to_sec()
+            if t >= newest[0]:
+                if t - newest[0] > self.tolerance:
+                    return None
+                return newest[1:]
+            # scans are usually recent, so search backwards from the newest sample
+            after = newest
+            for before in reversed(self.samples):
+                if before[0] <= t:
+                    break
+                after = before
+            else:
+                # the requested time is older than anything we have kept
+                return None
+
+        span = after[0] - before[0]
+        ratio = (t - before[0]) / span if span > 0 else 0.0
+        return (before[1] + ratio*(after[1] - before[1]),
+                before[2] + ratio*(after[2] - before[2]),
+                angle_normalize(before[3] + ratio*angle_diff(after[3], before[3])))
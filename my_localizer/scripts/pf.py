@@ -3,12 +3,14 @@
 """ This is the starter code for the robot localization project """
 
 import rospy
+import rospkg
 
 from dynamic_reconfigure.server import Server
 from my_localizer.cfg import PfConfig
 
 from std_msgs.msg import Header, String, ColorRGBA
 from sensor_msgs.msg import LaserScan
+from nav_msgs.msg import Odometry
 from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion, Vector3
 from visualization_msgs.msg import Marker, MarkerArray
 from nav_msgs.srv import GetMap
@@ -21,6 +23,7 @@ from tf.transformations import euler_from_quaternion, rotation_matrix, quaternio
 from random import gauss
 
 import math
+import os
 import time
 
 import numpy as np
@@ -30,11 +33,11 @@ import matplotlib.cm as cmx
 from numpy.random import random_sample
 from sklearn.neighbors import NearestNeighbors
 from occupancy_field import OccupancyField
+from odometry_buffer import OdometryBuffer
+from checkpoint import FilterCheckpoint
 from scipy.stats import norm
 
-from helper_functions import (convert_pose_inverse_transform,
-                              convert_translation_rotation_to_pose,
-                              convert_pose_to_xy_and_theta,
+from helper_functions import (convert_pose_to_xy_and_theta,
                               angle_diff)
 
 
@@ -75,6 +78,7 @@ class ParticleFilter:
             map_frame: the name of the map coordinate frame (should be "map" in most cases)
             odom_frame: the name of the odometry coordinate frame (should be "odom" in most cases)
             scan_topic: the name of the scan topic to listen to (should be "scan" in most cases)
+            odom_topic: the name of the odometry topic to listen to (should be "odom" in most cases)
             n_particles: the number of particles in the filter
             d_thresh: the amount of linear movement before triggering a filter update
             a_thresh: the amount of angular movement before triggering a filter update
@@ -84,10 +88,19 @@ class ParticleFilter:
             laser_subscriber: listens for new scan data on topic self.scan_topic
             tf_listener: listener for coordinate transforms
             tf_broadcaster: broadcaster for coordinate transforms
+            odom_buffer: a short history of odometry poses used to look up the robot's odometric pose at scan time
+            odom_subscriber: listens for new odometry data on topic self.odom_topic
+            laser_pose: the pose of the laser relative to the base (cached since this transform is static)
+            laser_frame: the frame that self.laser_pose was looked up for
             particle_cloud: a list of particles representing a probability distribution over robot poses
             current_odom_xy_theta: the pose of the robot in the odometry frame when the last filter update was performed.
                                    The pose is expressed as a list [x,y,theta] (where theta is the yaw)
             map: the map we will be localizing ourselves in.  The map should be of type nav_msgs/OccupancyGrid
+            checkpoint: periodically saves the filter state to disk so it can be resumed if the node restarts
+            resumed_map_to_odom_xy_theta: the map to odom offset restored from the checkpoint, held back until the first
+                                          odometry confirms the odometry frame survived the restart (None otherwise)
+            max_resume_odom_jump: the largest linear odometry change since the checkpoint we still treat as real motion
+            max_resume_odom_jump_angle: the largest angular odometry change since the checkpoint we still treat as real motion
     """
     def __init__(self):
         self.initialized = False        # make sure we don't perform updates before everything is setup
@@ -97,6 +110,7 @@ class ParticleFilter:
         self.map_frame = "map"          # the name of the map coordinate frame
         self.odom_frame = "odom"        # the name of the odometry coordinate frame
         self.scan_topic = "scan"        # the topic where we will get laser scans from 
+        self.odom_topic = rospy.get_param('~odom_topic', 'odom')     # the topic where we will get odometry from
 
         self.sample_factor = rospy.get_param('~sample_factor', 0.25)
         self.n_particles = int(self.sample_factor * rospy.get_param('~n_particles', 300))/self.sample_factor          # the number of particles to use
@@ -117,6 +131,10 @@ class ParticleFilter:
         self.linear_resample_sigma = rospy.get_param('~linear_resample_sigma', 0.1)
         self.angular_resample_sigma = rospy.get_param('~angular_resample_sigma', 5)*math.pi/180
 
+        # odometry changes since the checkpoint beyond these mean the odometry source restarted as well
+        self.max_resume_odom_jump = rospy.get_param('~max_resume_odom_jump', 1.0)
+        self.max_resume_odom_jump_angle = rospy.get_param('~max_resume_odom_jump_angle', 90)*math.pi/180
+
         # Setup pubs and subs
 
         # pose_listener responds to selection of a new approximate robot location (for instance using rviz)
@@ -135,10 +153,21 @@ class ParticleFilter:
         self.tf_listener = TransformListener()
         self.tf_broadcaster = TransformBroadcaster()
 
+        # keep a local history of odometry so the scan callback never has to wait on tf
+        self.odom_buffer = OdometryBuffer(self.odom_frame, self.base_frame,
+                                          rospy.get_param('~odom_buffer_duration', 2.0))
+        self.odom_subscriber = rospy.Subscriber(self.odom_topic, Odometry, self.odom_buffer.odom_received)
+
+        # the laser is rigidly mounted, so we only look up its pose when the scan frame changes
+        self.laser_pose = None
+        self.laser_frame = None
+
         self.particle_cloud = []
 
         self.current_odom_xy_theta = []
 
+        self.resumed_map_to_odom_xy_theta = None
+
         self.normal_dist = norm(0, self.model_noise_rate)
 
         # setup the dynamic reconfigure server
@@ -156,6 +185,14 @@ class ParticleFilter:
 
         # for now we have commented out the occupancy field initialization until you can successfully fetch the map
         self.occupancy_field = OccupancyField(got_map.map)
+
+        # resume from the last checkpoint (if it was taken on this map) and keep checkpointing from here on
+        checkpoint_path = rospy.get_param('~checkpoint_path', os.path.join(rospkg.get_ros_home(), 'pf_checkpoint.bin'))
+        self.checkpoint = FilterCheckpoint(checkpoint_path, got_map.map, rospy.get_param('~checkpoint_rate', 1.0))
+        self.resume_from_checkpoint()
+        if self.checkpoint.enabled:
+            rospy.on_shutdown(self.checkpoint.shutdown)
+
         self.initialized = True
         print "Initialization complete!"
 
@@ -319,8 +356,11 @@ class ParticleFilter:
         """ Callback function to handle re-initializing the particle filter based on a pose estimate.
             These pose estimates could be generated by another ROS Node or could come from the rviz GUI """
         xy_theta = convert_pose_to_xy_and_theta(msg.pose.pose)
+        # a new pose estimate supersedes anything we resumed from the checkpoint
+        self.resumed_map_to_odom_xy_theta = None
         self.initialize_particle_cloud(xy_theta)
         self.fix_map_to_odom_transform(msg)
+        self.save_checkpoint()
 
     def initialize_particle_cloud(self, xy_theta=None):
         """ Initialize the particle cloud.
@@ -395,28 +435,31 @@ class ParticleFilter:
             # wait for initialization to complete
             return
 
-        if not(self.tf_listener.canTransform(self.base_frame,msg.header.frame_id,msg.header.stamp)):
-            # need to know how to transform the laser to the base frame
-            # this will be given by either Gazebo or neato_node
-            return
-
-        if not(self.tf_listener.canTransform(self.base_frame,self.odom_frame,msg.header.stamp)):
-            # need to know how to transform between base and odometric frames
+        if self.laser_frame != msg.header.frame_id:
+            if not(self.tf_listener.canTransform(self.base_frame,msg.header.frame_id,rospy.Time(0))):
+                # need to know how to transform the laser to the base frame
+                # this will be given by either Gazebo or neato_node
+                return
+
+            # calculate pose of laser relative ot the robot base, this is static so we cache it
+            p = PoseStamped(header=Header(stamp=rospy.Time(0),
+                                          frame_id=msg.header.frame_id))
+            self.laser_pose = self.tf_listener.transformPose(self.base_frame,p)
+            self.laser_frame = msg.header.frame_id
+
+        # find out where the robot thinks it is based on its odometry (x,y,theta)
+        new_odom_xy_theta = self.odom_buffer.get_xy_theta(msg.header.stamp)
+        if new_odom_xy_theta is None:
+            # need odometry around the time of the scan
             # this will eventually be published by either Gazebo or neato_node
             return
+        self.odom_pose = PoseStamped(header=Header(stamp=msg.header.stamp,
+                                                   frame_id=self.odom_frame),
+                                     pose=Particle(*new_odom_xy_theta).as_pose())
 
-        # calculate pose of laser relative ot the robot base
-        p = PoseStamped(header=Header(stamp=rospy.Time(0),
-                                      frame_id=msg.header.frame_id))
-        self.laser_pose = self.tf_listener.transformPose(self.base_frame,p)
-
-        # find out where the robot thinks it is based on its odometry
-        p = PoseStamped(header=Header(stamp=msg.header.stamp,
-                                      frame_id=self.base_frame),
-                        pose=Pose())
-        self.odom_pose = self.tf_listener.transformPose(self.odom_frame, p)
-        # store the the odometry pose in a more convenient format (x,y,theta)
-        new_odom_xy_theta = convert_pose_to_xy_and_theta(self.odom_pose.pose)
+        if self.resumed_map_to_odom_xy_theta is not None:
+            # first odometry since we resumed from a checkpoint, make sure it continues where we left off
+            self.check_resumed_odometry(msg, new_odom_xy_theta)
 
         if not(self.particle_cloud):
             # now that we have all of the necessary transforms we can update the particle cloud
@@ -424,7 +467,8 @@ class ParticleFilter:
             # cache the last odometric pose so we can only update our particle filter if we move more than self.d_thresh or self.a_thresh
             self.current_odom_xy_theta = new_odom_xy_theta
             # update our map to odom transform now that the particles are initialized
-            self.fix_map_to_odom_transform(msg)
+            self.fix_map_to_odom_transform(msg, new_odom_xy_theta)
+            self.save_checkpoint()
         
         # elif not self.current_odom_xy_theta:
         #     self.current_odom_xy_theta = new_odom_xy_theta
@@ -439,24 +483,81 @@ class ParticleFilter:
                 self.update_particles_with_laser(msg)   # update based on laser scan
                 self.update_robot_pose()                # update robot's pose
                 self.resample_particles()               # resample particles to focus on areas of high density
-                self.fix_map_to_odom_transform(msg)     # update map to odom transform now that we have new particles
+                self.fix_map_to_odom_transform(msg, new_odom_xy_theta)  # update map to odom transform now that we have new particles
+                self.save_checkpoint()                  # snapshot the filter so we can resume after a restart
         # publish particles (so things like rviz can see them)
         #self.publish_particles(msg)
         self.publish_particles_colored()
 
 
-    def fix_map_to_odom_transform(self, msg):
+    def fix_map_to_odom_transform(self, msg, odom_xy_theta=None):
         """ This method constantly updates the offset of the map and 
             odometry coordinate systems based on the latest results from
-            the localizer
-            TODO: if you want to learn a lot about tf, reimplement this... I can provide
-                  you with some hints as to what is going on here. """
-        (translation, rotation) = convert_pose_inverse_transform(self.robot_pose)
-        p = PoseStamped(pose=convert_translation_rotation_to_pose(translation,rotation),
-                        header=Header(stamp=msg.header.stamp,frame_id=self.base_frame))
-        self.tf_listener.waitForTransform(self.base_frame, self.odom_frame, msg.header.stamp, rospy.Duration(1.0))
-        self.odom_to_map = self.tf_listener.transformPose(self.odom_frame, p)
-        (self.translation, self.rotation) = convert_pose_inverse_transform(self.odom_to_map.pose)
+            the localizer.  The offset is the robot pose in the map frame
+            composed with the inverse of the robot pose in the odometry frame,
+            which in 2D can be computed directly without going through tf.
+            odom_xy_theta: the odometric pose matching self.robot_pose, if omitted
+                           it is looked up from the odometry buffer at msg's stamp """
+        if odom_xy_theta is None:
+            odom_xy_theta = self.odom_buffer.get_xy_theta(msg.header.stamp)
+        if odom_xy_theta is None:
+            # fall back on the newest odometry we have rather than waiting for more
+            odom_xy_theta = self.odom_buffer.get_xy_theta()
+            if odom_xy_theta is None:
+                return
+        map_xy_theta = convert_pose_to_xy_and_theta(self.robot_pose)
+
+        # rotate the odometric position into the map frame and find the offset between the two origins
+        theta = angle_diff(map_xy_theta[2], odom_xy_theta[2])
+        x = map_xy_theta[0] - (math.cos(theta)*odom_xy_theta[0] - math.sin(theta)*odom_xy_theta[1])
+        y = map_xy_theta[1] - (math.sin(theta)*odom_xy_theta[0] + math.cos(theta)*odom_xy_theta[1])
+
+        self.translation = (x, y, 0.0)
+        self.rotation = tf.transformations.quaternion_from_euler(0,0,theta)
+
+    def save_checkpoint(self):
+        """ Hand the current filter state to the checkpoint, which writes it out on its own thread """
+        if not(self.current_odom_xy_theta and hasattr(self,'translation') and hasattr(self,'rotation')):
+            return
+        map_to_odom_xy_theta = (self.translation[0], self.translation[1], euler_from_quaternion(self.rotation)[2])
+        self.checkpoint.save(self.particle_cloud, self.current_odom_xy_theta, map_to_odom_xy_theta)
+
+    def resume_from_checkpoint(self):
+        """ Restore the particle cloud, last odometric pose and map to odom transform from the checkpoint """
+        state = self.checkpoint.load()
+        if state is None:
+            return
+        (particles, odom_xy_theta, map_to_odom_xy_theta) = state
+        self.particle_cloud = [Particle(x,y,theta,w) for (x,y,theta,w) in particles.T]
+        self.current_odom_xy_theta = odom_xy_theta
+        # don't broadcast the saved offset until we know the odometry frame is the one it was computed for
+        self.resumed_map_to_odom_xy_theta = map_to_odom_xy_theta
+        self.update_robot_pose()
+        print "Resumed " + str(len(self.particle_cloud)) + " particles from checkpoint!"
+
+    def check_resumed_odometry(self, msg, new_odom_xy_theta):
+        """ Compare the first odometry after resuming with the odometric pose saved in the checkpoint.
+            If the jump between them is too large to be real motion (e.g. the odometry source was
+            restarted too) keep the restored particles, but re-anchor the filter to the new odometry
+            instead of moving every particle by the jump. """
+        map_to_odom_xy_theta = self.resumed_map_to_odom_xy_theta
+        self.resumed_map_to_odom_xy_theta = None
+        if map_to_odom_xy_theta is None:
+            # an initialpose arrived in the meantime and replaced the resumed state
+            return
+        saved_odom_xy_theta = self.current_odom_xy_theta
+
+        if (math.hypot(new_odom_xy_theta[0] - saved_odom_xy_theta[0],
+                       new_odom_xy_theta[1] - saved_odom_xy_theta[1]) > self.max_resume_odom_jump or
+            math.fabs(angle_diff(new_odom_xy_theta[2], saved_odom_xy_theta[2])) > self.max_resume_odom_jump_angle):
+            print "Odometry jumped since the checkpoint, re-anchoring the resumed particles"
+            self.current_odom_xy_theta = new_odom_xy_theta
+            self.fix_map_to_odom_transform(msg, new_odom_xy_theta)
+            self.save_checkpoint()
+        else:
+            # the odometry frame survived the restart, so the saved offset still holds
+            self.translation = (map_to_odom_xy_theta[0], map_to_odom_xy_theta[1], 0.0)
+            self.rotation = tf.transformations.quaternion_from_euler(0,0,map_to_odom_xy_theta[2])
 
     def broadcast_last_transform(self):
         """ Make sure that we are always broadcasting the last map